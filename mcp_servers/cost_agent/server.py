@@ -5,26 +5,35 @@ Uses Groq (FREE) - llama-3.3-70b-versatile
 """
 
 import os
-import json
-import logging
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastmcp import FastMCP
-from openai import AsyncOpenAI
+from fastmcp import FastMCP, Context
+from mcp_servers.llm import groq_client, setup_logging, stream_json_completion
+from mcp_servers.pricing import compute_cost
 
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("cost-agent")
+logger = setup_logging("cost-agent")
+
+
+@asynccontextmanager
+async def lifespan(server: FastMCP):
+    yield
+    await client.close()
+
 
 mcp = FastMCP(
     name="QuerySense Cost Agent",
-    instructions="I analyze SQL queries for cloud cost inefficiencies and rewrite them to minimize data scanned and compute used."
+    instructions="I analyze SQL queries for cloud cost inefficiencies and rewrite them to minimize data scanned and compute used.",
+    lifespan=lifespan
 )
 
-client = AsyncOpenAI(
-    api_key=os.getenv("GROQ_API_KEY"),
-    base_url="https://api.groq.com/openai/v1"
-)
+client = groq_client()
+
+MODEL = "llama-3.3-70b-versatile"
+
+# A report runs ~600 tokens; the cap cuts off runaway generations early
+MAX_TOKENS = 800
 
 SYSTEM_PROMPT = """You are a cloud data warehouse cost optimization specialist. You've saved companies millions in BigQuery, Snowflake, Redshift, and Databricks bills.
 
@@ -50,33 +59,37 @@ Return this exact JSON structure:
   "model": "llama-3.3-70b"
 }"""
 
+# Built once; only the user message after it changes per call
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+def user_message(query: str, dialect: str) -> dict:
+    """Per-request suffix — dialect and query, always after the static prefix."""
+    return {"role": "user", "content": f"SQL Dialect/Warehouse: {dialect}\n\nQuery to analyze:\n```sql\n{query}\n```"}
+
 
 @mcp.tool(
     description="Analyze a SQL query for cloud cost inefficiencies and rewrite it to minimize compute and data scanned"
 )
-async def analyze_sql_cost(query: str, dialect: str = "bigquery") -> dict:
+async def analyze_sql_cost(query: str, dialect: str = "bigquery", ctx: Context | None = None) -> dict:
     """Analyze SQL query for cost optimization opportunities."""
-    logger.info(f"Cost Agent analyzing query ({len(query)} chars)")
+    logger.info("Cost Agent analyzing query (%d chars)", len(query))
 
     try:
-        response = await client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            response_format={"type": "json_object"},
-            temperature=0.1,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"SQL Dialect/Warehouse: {dialect}\n\nQuery to analyze:\n```sql\n{query}\n```"}
-            ]
+        result, usage = await stream_json_completion(
+            client, MODEL, [SYSTEM_MESSAGE, user_message(query, dialect)], MAX_TOKENS, ctx
         )
-
-        result = json.loads(response.choices[0].message.content)
-        result["tokens_used"] = response.usage.total_tokens
-        result["cost_usd"] = 0.0  # Groq is free!
-        logger.info(f"Cost Agent done. Cost rating: {result.get('cost_rating')}")
+        result["tokens_used"] = usage.total_tokens if usage else None
+        # SYSTEM_PROMPT is a fixed prefix, so providers with prefix caching
+        # serve it from cache after the first call; report how much was reused
+        details = getattr(usage, "prompt_tokens_details", None)
+        result["cached_tokens"] = getattr(details, "cached_tokens", None) or 0
+        result["cost_usd"] = compute_cost(usage, MODEL)
+        logger.info("Cost Agent done. Cost rating: %s", result.get('cost_rating'))
         return result
 
     except Exception as e:
-        logger.error(f"Cost Agent error: {e}")
+        logger.error("Cost Agent error: %s", e)
         return {
             "error": str(e),
             "agent": "Cost Agent 💰",
@@ -94,5 +107,5 @@ async def analyze_sql_cost(query: str, dialect: str = "bigquery") -> dict:
 
 if __name__ == "__main__":
     port = int(os.getenv("COST_AGENT_PORT", "8002"))
-    logger.info(f"💰 Cost Agent starting on port {port}")
+    logger.info("💰 Cost Agent starting on port %s", port)
     mcp.run(transport="sse", host="0.0.0.0", port=port)
\ No newline at end of file
@@ -5,26 +5,36 @@ Uses Groq (FREE) - llama-3.3-70b-versatile
 """
 
 import os
-import json
-import logging
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastmcp import FastMCP
-from openai import AsyncOpenAI
+from fastmcp import FastMCP, Context
+from mcp_servers.llm import groq_client, setup_logging, stream_json_completion
+from mcp_servers.pricing import compute_cost
+from mcp_servers.reports import slim_report
 
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("judge-agent")
+logger = setup_logging("judge-agent")
+
+
+@asynccontextmanager
+async def lifespan(server: FastMCP):
+    yield
+    await client.close()
+
 
 mcp = FastMCP(
     name="QuerySense Judge Agent",
-    instructions="I review reports from 3 SQL specialist agents, pick the best approach, and synthesize the ultimate optimized query."
+    instructions="I review reports from 3 SQL specialist agents, pick the best approach, and synthesize the ultimate optimized query.",
+    lifespan=lifespan
 )
 
-client = AsyncOpenAI(
-    api_key=os.getenv("GROQ_API_KEY"),
-    base_url="https://api.groq.com/openai/v1"
-)
+client = groq_client()
+
+MODEL = "llama-3.3-70b-versatile"
+
+# A verdict runs ~900 tokens; the cap cuts off runaway generations early
+MAX_TOKENS = 1200
 
 SYSTEM_PROMPT = """You are the Chief SQL Architect and head judge of the QuerySense optimization competition.
 
@@ -68,17 +78,28 @@ Return this exact JSON structure:
   "model": "llama-3.3-70b"
 }"""
 
+# Built once; only the user message after it changes per call
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
 
 @mcp.tool(
     description="Judge the 3 agent SQL reports, pick a winner, and synthesize the ultimate optimized query"
 )
 async def judge_sql_results(
     original_query: str,
-    performance_report: dict,
-    cost_report: dict,
-    security_report: dict
+    performance_report: dict | None = None,
+    cost_report: dict | None = None,
+    security_report: dict | None = None,
+    performance_report_json: str | None = None,
+    cost_report_json: str | None = None,
+    security_report_json: str | None = None,
+    ctx: Context | None = None
 ) -> dict:
-    """Judge all three agent reports and produce final verdict + unified SQL."""
+    """Judge all three agent reports and produce final verdict + unified SQL.
+
+    Each report can be passed as a dict, or as compact JSON text under the
+    matching *_json argument, which is embedded in the prompt as-is.
+    """
     logger.info("Judge Agent reviewing all reports...")
 
     context = f"""ORIGINAL QUERY:
@@ -87,34 +108,26 @@ async def judge_sql_results(
 ```
 
 PERFORMANCE AGENT REPORT:
-{json.dumps(performance_report, indent=2)}
+{performance_report_json or slim_report(performance_report or {})}
 
 COST AGENT REPORT:
-{json.dumps(cost_report, indent=2)}
+{cost_report_json or slim_report(cost_report or {})}
 
 SECURITY AGENT REPORT:
-{json.dumps(security_report, indent=2)}
+{security_report_json or slim_report(security_report or {})}
 """
 
     try:
-        response = await client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            response_format={"type": "json_object"},
-            temperature=0.2,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": context}
-            ]
+        result, usage = await stream_json_completion(
+            client, MODEL, [SYSTEM_MESSAGE, {"role": "user", "content": context}], MAX_TOKENS, ctx
         )
-
-        result = json.loads(response.choices[0].message.content)
-        result["tokens_used"] = response.usage.total_tokens
-        result["cost_usd"] = 0.0  # Groq is free!
-        logger.info(f"Judge verdict: {result.get('winner')} wins!")
+        result["tokens_used"] = usage.total_tokens if usage else None
+        result["cost_usd"] = compute_cost(usage, MODEL)
+        logger.info("Judge verdict: %s wins!", result.get('winner'))
         return result
 
     except Exception as e:
-        logger.error(f"Judge Agent error: {e}")
+        logger.error("Judge Agent error: %s", e)
         return {
             "error": str(e),
             "agent": "Judge Agent ⚖️",
@@ -137,5 +150,5 @@ SECURITY AGENT REPORT:
 
 if __name__ == "__main__":
     port = int(os.getenv("JUDGE_AGENT_PORT", "8004"))
-    logger.info(f"⚖️  Judge Agent starting on port {port}")
+    logger.info("⚖️  Judge Agent starting on port %s", port)
     mcp.run(transport="sse", host="0.0.0.0", port=port)
\ No newline at end of file
@@ -0,0 +1,76 @@
+"""
+QuerySense — Agent server plumbing 🔧
+Logging, the Groq client and the streamed JSON completion loop, shared by
+every agent server so each one only carries its own prompts and report shape.
+"""
+
+import os
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+import httpx
+import orjson
+from fastmcp import Context
+from openai import AsyncOpenAI
+
+
+def setup_logging(name: str) -> logging.Logger:
+    """Route logging through a queue, so log I/O happens on a listener
+    thread, off the event loop. Returns the server's logger."""
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+    listener = QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    atexit.register(listener.stop)  # Flush queued records on exit
+    return logging.getLogger(name)
+
+
+def groq_client() -> AsyncOpenAI:
+    """Groq's OpenAI-compatible API over one pooled HTTP/2 connection set,
+    reused by every tool call. Call after load_dotenv()."""
+    return AsyncOpenAI(
+        api_key=os.getenv("GROQ_API_KEY"),
+        base_url="https://api.groq.com/openai/v1",
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+    )
+
+
+async def stream_json_completion(
+    client: AsyncOpenAI,
+    model: str,
+    messages: list,
+    max_tokens: int,
+    ctx: Context | None = None
+) -> tuple:
+    """Run a greedy, seeded JSON-mode completion and return (result, usage).
+
+    Tokens are forwarded as MCP progress notifications while the completion
+    streams, so the UI can show them live.
+    """
+    stream = await client.chat.completions.create(
+        model=model,
+        response_format={"type": "json_object"},
+        temperature=0.0,
+        seed=42,
+        max_tokens=max_tokens,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+
+    chunks, usage = [], None
+    async for chunk in stream:
+        usage = chunk.usage or usage
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            chunks.append(delta)
+            if ctx is not None:
+                await ctx.report_progress(len(chunks), message=delta)
+
+    return orjson.loads("".join(chunks)), usage
@@ -5,27 +5,36 @@ Uses Groq (FREE) - llama-3.3-70b-versatile
 """
 
 import os
-import json
-import logging
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastmcp import FastMCP
-from openai import AsyncOpenAI
+from fastmcp import FastMCP, Context
+from mcp_servers.llm import groq_client, setup_logging, stream_json_completion
+from mcp_servers.pricing import compute_cost
 
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("performance-agent")
+logger = setup_logging("performance-agent")
+
+
+@asynccontextmanager
+async def lifespan(server: FastMCP):
+    yield
+    await client.close()
+
 
 mcp = FastMCP(
     name="QuerySense Performance Agent",
-    instructions="I analyze SQL queries for performance bottlenecks and rewrite them for maximum speed."
+    instructions="I analyze SQL queries for performance bottlenecks and rewrite them for maximum speed.",
+    lifespan=lifespan
 )
 
 # Groq is OpenAI-compatible — just swap base_url and model
-client = AsyncOpenAI(
-    api_key=os.getenv("GROQ_API_KEY"),
-    base_url="https://api.groq.com/openai/v1"
-)
+client = groq_client()
+
+MODEL = "llama-3.3-70b-versatile"
+
+# A report runs ~600 tokens; the cap cuts off runaway generations early
+MAX_TOKENS = 800
 
 SYSTEM_PROMPT = """You are an elite SQL performance engineer with 20+ years of experience optimizing queries at scale.
 
@@ -51,33 +60,34 @@ Return this exact JSON structure:
   "model": "llama-3.3-70b"
 }"""
 
+# Static prefix, built once: the same bytes on every call, so the provider's
+# prefix cache can serve it. Only the trailing user message varies.
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+def user_message(query: str, dialect: str) -> dict:
+    """Per-request suffix — dialect and query, always after the static prefix."""
+    return {"role": "user", "content": f"SQL Dialect: {dialect}\n\nQuery to analyze:\n```sql\n{query}\n```"}
+
 
 @mcp.tool(
     description="Analyze a SQL query for performance bottlenecks and rewrite it for maximum speed"
 )
-async def analyze_sql_performance(query: str, dialect: str = "postgresql") -> dict:
+async def analyze_sql_performance(query: str, dialect: str = "postgresql", ctx: Context | None = None) -> dict:
     """Analyze SQL query for performance issues."""
-    logger.info(f"Performance Agent analyzing query ({len(query)} chars)")
+    logger.info("Performance Agent analyzing query (%d chars)", len(query))
 
     try:
-        response = await client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            response_format={"type": "json_object"},
-            temperature=0.1,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"SQL Dialect: {dialect}\n\nQuery to analyze:\n```sql\n{query}\n```"}
-            ]
+        result, usage = await stream_json_completion(
+            client, MODEL, [SYSTEM_MESSAGE, user_message(query, dialect)], MAX_TOKENS, ctx
         )
-
-        result = json.loads(response.choices[0].message.content)
-        result["tokens_used"] = response.usage.total_tokens
-        result["cost_usd"] = 0.0  # Groq is free!
-        logger.info(f"Performance Agent done. Severity: {result.get('severity')}")
+        result["tokens_used"] = usage.total_tokens if usage else None
+        result["cost_usd"] = compute_cost(usage, MODEL)
+        logger.info("Performance Agent done. Severity: %s", result.get('severity'))
         return result
 
     except Exception as e:
-        logger.error(f"Performance Agent error: {e}")
+        logger.error("Performance Agent error: %s", e)
         return {
             "error": str(e),
             "agent": "Performance Agent 🚀",
@@ -93,7 +103,82 @@ async def analyze_sql_performance(query: str, dialect: str = "postgresql") -> di
         }
 
 
+FUSED_SYSTEM_PROMPT = """You are a panel of three SQL specialists reviewing the same query in one pass:
+- A Performance Agent 🚀 — an elite SQL performance engineer (bottlenecks, missing indexes, N+1 patterns, full scans, unnecessary subqueries, implicit conversions; rewrite for speed, estimate speedup, suggest indexes)
+- A Cost Agent 💰 — a cloud data warehouse cost specialist (SELECT *, missing partition filters, no LIMIT, unbounded JOINs, unnecessary DISTINCT; rewrite to minimize bytes scanned, estimate cost reduction, suggest partitioning/clustering)
+- A Security Agent 🔒 — a database security expert (SQL injection, data over-exposure, privilege escalation, UNION-based exfiltration, missing row-level security, GDPR/HIPAA exposure; rewrite with parameterization and least privilege)
+
+Each specialist works independently and writes its own rewritten SQL.
+
+IMPORTANT: Return ONLY valid JSON, no markdown, no explanation outside the JSON.
+Write the sections in this order, completing each one before starting the next.
+
+Return this exact JSON structure:
+{
+  "performance": {
+    "issues_found": ["list of specific problems identified"],
+    "severity": "critical|high|medium|low",
+    "original_rating": "Poor|Fair|Good|Excellent",
+    "rewritten_sql": "the optimized SQL query",
+    "changes_made": ["list of specific changes with reasons"],
+    "estimated_speedup": "e.g. 5-10x faster",
+    "index_suggestions": ["CREATE INDEX suggestions"],
+    "agent": "Performance Agent 🚀",
+    "model": "llama-3.3-70b"
+  },
+  "cost": {
+    "cost_rating": "Low|Medium|High|Very High",
+    "expensive_operations": ["list of specific cost-driving operations"],
+    "severity": "critical|high|medium|low",
+    "rewritten_sql": "the cost-optimized SQL query",
+    "savings_explanation": ["list of specific changes with cost impact"],
+    "estimated_cost_reduction_pct": "e.g. 70-85%",
+    "partitioning_suggestions": ["partitioning/clustering recommendations"],
+    "agent": "Cost Agent 💰",
+    "model": "llama-3.3-70b"
+  },
+  "security": {
+    "risk_level": "Critical|High|Medium|Low|Safe",
+    "vulnerabilities": ["list of specific vulnerabilities found"],
+    "severity": "critical|high|medium|low",
+    "rewritten_sql": "the security-hardened SQL query",
+    "security_improvements": ["list of specific security changes made"],
+    "compliance_notes": ["GDPR/HIPAA/SOC2 relevant observations"],
+    "parameterization_example": "example of how to use this query safely with parameters",
+    "agent": "Security Agent 🔒",
+    "model": "llama-3.3-70b"
+  }
+}"""
+
+FUSED_SYSTEM_MESSAGE = {"role": "system", "content": FUSED_SYSTEM_PROMPT}
+
+
+@mcp.tool(
+    description="Run the performance, cost, and security analyses of a SQL query in a single LLM call"
+)
+async def analyze_sql_all(query: str, dialect: str = "postgresql", ctx: Context | None = None) -> dict:
+    """Fused analysis — one prompt prefill and round-trip instead of three."""
+    logger.info("Fused analysis of query (%d chars)", len(query))
+
+    try:
+        result, usage = await stream_json_completion(
+            client, MODEL, [FUSED_SYSTEM_MESSAGE, user_message(query, dialect)], 3 * MAX_TOKENS, ctx
+        )
+        result["tokens_used"] = usage.total_tokens if usage else None
+        reports = [report for report in result.values() if isinstance(report, dict)]
+        for report in reports:
+            # One call answered for every section; split its usage and cost evenly
+            report["tokens_used"] = round(usage.total_tokens / len(reports)) if usage else None
+            report["cost_usd"] = round(compute_cost(usage, MODEL) / len(reports), 6)
+        logger.info("Fused analysis done. Sections: %s", sorted(result))
+        return result
+
+    except Exception as e:
+        logger.error("Fused analysis error: %s", e)
+        return {"error": str(e)}
+
+
 if __name__ == "__main__":
     port = int(os.getenv("PERFORMANCE_AGENT_PORT", "8001"))
-    logger.info(f"🚀 Performance Agent starting on port {port}")
+    logger.info("🚀 Performance Agent starting on port %s", port)
     mcp.run(transport="sse", host="0.0.0.0", port=port)
\ No newline at end of file
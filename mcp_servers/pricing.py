@@ -0,0 +1,60 @@
+"""
+QuerySense — Token pricing 💲
+One place for per-model token prices, shared by every agent server and the
+batch path, so cost figures can't drift apart between them.
+"""
+
+import os
+from functools import lru_cache
+
+# USD per 1M tokens: (input, output), Groq on-demand pricing
+PRICES = {
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+}
+
+# Groq's free tier bills nothing; set GROQ_FREE_TIER=0 to report on-demand costs
+FREE_TIER = os.getenv("GROQ_FREE_TIER", "1") == "1"
+
+# Prompt tokens served from the provider's prefix cache bill at half the input price
+CACHED_INPUT_DISCOUNT = 0.5
+# Batch API requests bill at half price
+BATCH_DISCOUNT = 0.5
+
+
+@lru_cache(maxsize=None)
+def price_per_token(model: str, token_type: str) -> float:
+    """USD per token of `token_type` ("input", "cached_input" or "output")."""
+    if FREE_TIER or model not in PRICES:
+        return 0.0
+    input_price, output_price = PRICES[model]
+    per_million = {
+        "input": input_price,
+        "cached_input": input_price * CACHED_INPUT_DISCOUNT,
+        "output": output_price,
+    }[token_type]
+    return per_million / 1_000_000
+
+
+def _field(obj, name: str):
+    """Read a usage field from an SDK object or a plain dict (batch output)."""
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def compute_cost(usage, model: str, batch: bool = False) -> float:
+    """Cost in USD of a completion's `usage`, with cached prompt tokens discounted."""
+    if usage is None:
+        return 0.0
+    prompt = _field(usage, "prompt_tokens") or 0
+    completion = _field(usage, "completion_tokens") or 0
+    cached = _field(_field(usage, "prompt_tokens_details"), "cached_tokens") or 0
+
+    cost = (
+        (prompt - cached) * price_per_token(model, "input")
+        + cached * price_per_token(model, "cached_input")
+        + completion * price_per_token(model, "output")
+    )
+    if batch:
+        cost *= BATCH_DISCOUNT
+    return round(cost, 6)
@@ -0,0 +1,34 @@
+"""
+QuerySense — Judge report view 📋
+The one allowlist of agent report fields the judge reasons about, shared by
+the judge server and the orchestrator, so every path into the judge prompt
+trims reports the same way.
+"""
+
+import orjson
+
+# Report fields the judge actually reasons about; bookkeeping such as
+# tokens_used, cost_usd and model would only add prompt tokens
+REPORT_FIELDS = {
+    "rewritten_sql",
+    "issues_found",
+    "changes_made",
+    "severity",
+    "cost_rating",
+    "risk_level",
+    "vulnerabilities",
+    "expensive_operations",
+    "savings_explanation",
+    "security_improvements",
+    "error",
+}
+
+
+def judge_view(report: dict) -> dict:
+    """Just the fields of `report` the judge needs."""
+    return {k: v for k, v in report.items() if k in REPORT_FIELDS}
+
+
+def slim_report(report: dict) -> str:
+    """Compact JSON of just the fields the judge needs."""
+    return orjson.dumps(judge_view(report)).decode()
@@ -5,26 +5,35 @@ Uses Groq (FREE) - llama-3.3-70b-versatile
 """
 
 import os
-import json
-import logging
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastmcp import FastMCP
-from openai import AsyncOpenAI
+from fastmcp import FastMCP, Context
+from mcp_servers.llm import groq_client, setup_logging, stream_json_completion
+from mcp_servers.pricing import compute_cost
 
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("security-agent")
+logger = setup_logging("security-agent")
+
+
+@asynccontextmanager
+async def lifespan(server: FastMCP):
+    yield
+    await client.close()
+
 
 mcp = FastMCP(
     name="QuerySense Security Agent",
-    instructions="I analyze SQL queries for security vulnerabilities, injection risks, and data exposure issues."
+    instructions="I analyze SQL queries for security vulnerabilities, injection risks, and data exposure issues.",
+    lifespan=lifespan
 )
 
-client = AsyncOpenAI(
-    api_key=os.getenv("GROQ_API_KEY"),
-    base_url="https://api.groq.com/openai/v1"
-)
+client = groq_client()
+
+MODEL = "llama-3.3-70b-versatile"
+
+# A report runs ~600 tokens; the cap cuts off runaway generations early
+MAX_TOKENS = 800
 
 SYSTEM_PROMPT = """You are a database security expert and SQL injection specialist. You've found critical vulnerabilities in Fortune 500 companies' data layers.
 
@@ -52,33 +61,33 @@ Return this exact JSON structure:
   "model": "llama-3.3-70b"
 }"""
 
+# Built once; only the user message after it changes per call
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+def user_message(query: str, dialect: str) -> dict:
+    """Per-request suffix — dialect and query, always after the static prefix."""
+    return {"role": "user", "content": f"SQL Dialect: {dialect}\n\nQuery to analyze:\n```sql\n{query}\n```"}
+
 
 @mcp.tool(
     description="Analyze a SQL query for security vulnerabilities, injection risks, and data exposure issues"
 )
-async def analyze_sql_security(query: str, dialect: str = "postgresql") -> dict:
+async def analyze_sql_security(query: str, dialect: str = "postgresql", ctx: Context | None = None) -> dict:
     """Analyze SQL query for security vulnerabilities."""
-    logger.info(f"Security Agent analyzing query ({len(query)} chars)")
+    logger.info("Security Agent analyzing query (%d chars)", len(query))
 
     try:
-        response = await client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            response_format={"type": "json_object"},
-            temperature=0.1,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"SQL Dialect: {dialect}\n\nQuery to analyze:\n```sql\n{query}\n```"}
-            ]
+        result, usage = await stream_json_completion(
+            client, MODEL, [SYSTEM_MESSAGE, user_message(query, dialect)], MAX_TOKENS, ctx
         )
-
-        result = json.loads(response.choices[0].message.content)
-        result["tokens_used"] = response.usage.total_tokens
-        result["cost_usd"] = 0.0  # Groq is free!
-        logger.info(f"Security Agent done. Risk level: {result.get('risk_level')}")
+        result["tokens_used"] = usage.total_tokens if usage else None
+        result["cost_usd"] = compute_cost(usage, MODEL)
+        logger.info("Security Agent done. Risk level: %s", result.get('risk_level'))
         return result
 
     except Exception as e:
-        logger.error(f"Security Agent error: {e}")
+        logger.error("Security Agent error: %s", e)
         return {
             "error": str(e),
             "agent": "Security Agent 🔒",
@@ -96,5 +105,5 @@ async def analyze_sql_security(query: str, dialect: str = "postgresql") -> dict:
 
 if __name__ == "__main__":
     port = int(os.getenv("SECURITY_AGENT_PORT", "8003"))
-    logger.info(f"🔒 Security Agent starting on port {port}")
+    logger.info("🔒 Security Agent starting on port %s", port)
     mcp.run(transport="sse", host="0.0.0.0", port=port)
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""
+QuerySense — Batch analysis 📦
+Runs the 3 agent analyses for many queries through Groq's Batch API
+(OpenAI-compatible, 50% cheaper, results within the completion window).
+The judge stays online: it needs all 3 reports, so it runs once they are in.
+"""
+
+import os
+import logging
+import orjson
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+from mcp_servers.pricing import compute_cost
+
+load_dotenv()
+
+logger = logging.getLogger("orchestrator.batch")
+
+client = AsyncOpenAI(
+    api_key=os.getenv("GROQ_API_KEY"),
+    base_url="https://api.groq.com/openai/v1"
+)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = os.getenv("QS_BATCH_WINDOW", "24h")
+
+
+def agent_servers() -> dict:
+    """Import the agent server modules (run from the project root), whose
+    prompts and message builders the batch requests reuse."""
+    from mcp_servers.performance_agent import server as performance
+    from mcp_servers.cost_agent import server as cost
+    from mcp_servers.security_agent import server as security
+
+    return {"performance": performance, "cost": cost, "security": security}
+
+
+def batch_lines(queries: list) -> bytes:
+    """One chat-completion request per (query, agent), as Batch API JSONL."""
+    servers = agent_servers()
+    lines = []
+    for i, item in enumerate(queries):
+        for agent_key, server in servers.items():
+            lines.append(orjson.dumps({
+                "custom_id": f"{i}:{agent_key}",
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {
+                    "model": server.MODEL,
+                    "response_format": {"type": "json_object"},
+                    "temperature": 0.0,
+                    "seed": 42,
+                    "max_tokens": server.MAX_TOKENS,
+                    "messages": [
+                        server.SYSTEM_MESSAGE,
+                        server.user_message(item["query"], item["dialect"])
+                    ],
+                },
+            }))
+    return b"\n".join(lines) + b"\n"
+
+
+async def submit_batch(queries: list) -> str:
+    """Upload the agent requests for `queries` and start a batch; returns its id.
+
+    The submitted items go up as a sidecar JSONL named in the batch metadata,
+    so results can be matched to queries without any server-side state (which
+    a restart or --reload would lose).
+    """
+    queries_file = await client.files.create(
+        file=("querysense-queries.jsonl", b"".join(orjson.dumps(item) + b"\n" for item in queries)),
+        purpose="batch"
+    )
+    batch_file = await client.files.create(
+        file=("querysense-batch.jsonl", batch_lines(queries)),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW,
+        metadata={"queries_file_id": queries_file.id}
+    )
+    logger.info("📦 Submitted batch %s (%d queries)", batch.id, len(queries))
+    return batch.id
+
+
+def parse_output_line(line: dict) -> dict:
+    """Agent report from one Batch API output line, shaped like the MCP tool result."""
+    response = line.get("response") or {}
+    if line.get("error") or response.get("status_code") != 200:
+        error = line.get("error") or response.get("body", {}).get("error")
+        return {"error": str(error or "Batch request failed")}
+
+    body = response["body"]
+    try:
+        result = orjson.loads(body["choices"][0]["message"]["content"])
+    except (orjson.JSONDecodeError, KeyError, IndexError) as e:
+        return {"error": f"Could not parse batch response: {e}"}
+    result["tokens_used"] = body.get("usage", {}).get("total_tokens")
+    result["cost_usd"] = compute_cost(body.get("usage"), body.get("model", ""), batch=True)
+    return result
+
+
+async def collect_batch(batch_id: str) -> tuple:
+    """Return (status, queries, reports) for a batch. Once it has completed,
+    queries lists the submitted items and reports maps query index ->
+    {agent_key: report}; before that, both are None. Raises
+    openai.NotFoundError for an unknown batch id, and KeyError for a batch
+    that has no queries file, i.e. wasn't submitted by submit_batch()."""
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        return batch.status, None, None
+
+    content = await client.files.content((batch.metadata or {})["queries_file_id"])
+    queries = [orjson.loads(raw) for raw in content.read().splitlines() if raw.strip()]
+
+    reports: dict = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = await client.files.content(file_id)
+        for raw in content.read().splitlines():
+            if not raw.strip():
+                continue
+            line = orjson.loads(raw)
+            index, agent_key = line["custom_id"].split(":", 1)
+            reports.setdefault(int(index), {})[agent_key] = parse_output_line(line)
+    return batch.status, queries, reports
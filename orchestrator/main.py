@@ -6,23 +6,53 @@ Uses FastMCP Client to call each agent.
 """
 
 import os
-import json
 import time
+import pathlib
 import asyncio
+import re
+import gzip
+import random
+import hashlib
+import queue
+import atexit
 import logging
-from typing import AsyncGenerator
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict
+from itertools import combinations
+from contextlib import aclosing
+from typing import AsyncGenerator, Awaitable, Callable, Optional
 
-from fastapi import FastAPI, HTTPException
+import httpx
+import msgspec
+import orjson
+import sqlglot
+from rapidfuzz.distance import Levenshtein
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
 from dotenv import load_dotenv
 from fastmcp import Client
+from sse_starlette.sse import EventSourceResponse, ServerSentEvent
+from mcp_servers.reports import judge_view, slim_report
 
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(name)s] %(message)s")
+# Handlers only enqueue records; a listener thread does the stderr writes,
+# so a slow terminal or pipe never blocks the event loop
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(name)s] %(message)s",
+    handlers=[QueueHandler(_log_queue)]
+)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Flush queued records on exit
 logger = logging.getLogger("orchestrator")
 
 app = FastAPI(
@@ -38,6 +68,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+# Event streams must reach the client as each event is written, not when a
+# compressor buffer fills
+SSE_PATHS = {"/analyze"}
+# Precomputed bodies with a strong ETag: a gzip variant would share the
+# identity body's validator, so these go out as-is
+STRONG_ETAG_PATHS = {"/demo-queries"}
+
+
+class NonStreamingGZipMiddleware(GZipMiddleware):
+    """Gzip JSON and other buffered responses; pass event streams and
+    strong-ETag bodies through untouched."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in SSE_PATHS | STRONG_ETAG_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+# UI assets are precompressed by UIStaticFiles, which the middleware leaves alone
+app.add_middleware(NonStreamingGZipMiddleware, minimum_size=512)
+
 # Agent configuration - SSE transport
 AGENTS = {
     "performance": {
@@ -60,119 +113,1117 @@ AGENTS = {
     },
 }
 
+# Constant label/color members, serialized once and spliced into agent events,
+# plus per-agent event templates so only the changing fields are set per race
+for _key, _agent in AGENTS.items():
+    _agent["_static_json"] = orjson.dumps({
+        "agent_label": _agent["label"],
+        "agent_color": _agent["color"],
+    })[1:-1]
+    _agent["_done_template"] = {"event": "agent_done", "agent_key": _key}
+    _agent["_error_template"] = {"event": "agent_error", "agent_key": _key}
+
+# Events that carry an agent's static label/color fragment
+AGENT_EVENTS = {"agent_done", "agent_error"}
+LIVE_ONLY_EVENTS = {"agent_token", "preliminary_verdict", "judge_partial"}
+
+# QuerySense dialect names -> sqlglot dialects (unknown names parse as generic SQL)
+SQLGLOT_DIALECTS = {
+    "postgresql": "postgres",
+    "mysql": "mysql",
+    "bigquery": "bigquery",
+    "snowflake": "snowflake",
+    "redshift": "redshift",
+    "sqlite": "sqlite",
+    "databricks": "databricks",
+    "mssql": "tsql",
+}
+
 JUDGE_URL = f"http://localhost:{os.getenv('JUDGE_AGENT_PORT', '8004')}/sse"
 
+# LLM-backed tools are slow; connecting to a local agent should not be
+MCP_CALL_TIMEOUT = 90.0
+MCP_INIT_TIMEOUT = 5.0
+HEALTH_PROBE_TIMEOUT = 3.0
+
+# A hung agent is cut off early and retried; later attempts get the full budget
+MCP_FIRST_ATTEMPT_TIMEOUT = 15.0
+MCP_MAX_ATTEMPTS = 3
+
+MCP_TOOLS_CACHE_TTL = int(os.getenv("MCP_TOOLS_CACHE_TTL", "3600"))
+
+# Per-race event queue between the agent calls and the race's RaceBroadcast
+# task, which drains it as events arrive; slow SSE clients are handled per
+# subscriber by RaceBroadcast. Token previews may only fill the queue up to
+# TOKEN_QUEUE_LIMIT, leaving room for the agent/judge completions so those
+# never block on a full queue.
+UPDATE_QUEUE_SIZE = 16
+TOKEN_QUEUE_LIMIT = UPDATE_QUEUE_SIZE - len(AGENTS) - 1
+
+# Colocated deployments can call the agent tools in-process, skipping MCP over HTTP
+INPROC_AGENTS = os.getenv("QS_INPROC", "0") == "1"
+
+# Fast path: one fused LLM call (on the Performance Agent server) answers for all 3 agents
+FUSED_AGENTS = os.getenv("QS_FUSED_AGENTS", "0") == "1"
+FUSED_TOOL = "analyze_sql_all"
+
+
+# One TTL for every response cache; agent and judge reports are deterministic
+# enough for a repeated query to reuse them for an hour by default
+CACHE_TTL = int(os.getenv("QS_CACHE_TTL_SEC", "3600"))
+VERDICT_CACHE_SIZE = 1024
+AGENT_CACHE_SIZE = 3 * VERDICT_CACHE_SIZE
+JUDGE_CACHE_SIZE = VERDICT_CACHE_SIZE
+
+
+class TTLCache:
+    """In-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+# Full SSE event sequence of successful races, keyed by cache_key(dialect, query)
+_VERDICT_CACHE = TTLCache(CACHE_TTL, VERDICT_CACHE_SIZE)
+
+# Individual agent reports, keyed by agent_cache_key()
+_AGENT_CACHE = TTLCache(CACHE_TTL, AGENT_CACHE_SIZE)
+# [lock, holder + waiter count] per agent_cache_key() with a call in progress
+_AGENT_LOCKS: dict = {}
+
+# Judge verdicts, keyed by judge_cache_key() over the reports it was given
+_JUDGE_CACHE = TTLCache(CACHE_TTL, JUDGE_CACHE_SIZE)
+
+# RaceBroadcasts of the races currently running, keyed like _VERDICT_CACHE
+_INFLIGHT: dict = {}
+
+
+def elapsed_since(start_ns: int) -> float:
+    """Seconds since a time.monotonic_ns() reading, rounded for the SSE payloads."""
+    return round((time.monotonic_ns() - start_ns) / 1e9, 2)
+
+
+def cache_key(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+_WHITESPACE = re.compile(r"\s+")
+_QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def _normalize(query: str) -> str:
+    """Collapse whitespace and lowercase everything outside quoted literals and
+    identifiers, so formatting-only variants of a query share cache entries."""
+    parts = _QUOTED.split(query.strip().rstrip(";"))
+    return "".join(
+        part if i % 2 else _WHITESPACE.sub(" ", part).lower()
+        for i, part in enumerate(parts)
+    ).strip()
+
 
-class QueryRequest(BaseModel):
+def agent_cache_key(agent_key: str, dialect: str, query: str) -> str:
+    return cache_key(agent_key, dialect.lower(), _normalize(query))
+
+
+def report_hash(report: dict) -> str:
+    """Stable hash of the part of an agent report the judge sees, so reports
+    that differ only in token accounting share a judge cache entry."""
+    content = judge_view(report)
+    return hashlib.sha256(orjson.dumps(content, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def judge_cache_key(query: str, results: dict) -> str:
+    return cache_key(_normalize(query), *(report_hash(results[k]) for k in AGENTS))
+
+
+class QueryRequest(msgspec.Struct):
     query: str
     dialect: str = "postgresql"
 
 
-def sse_event(data: dict) -> str:
-    """Format a server-sent event."""
-    return f"data: {json.dumps(data)}\n\n"
+class BatchRequest(msgspec.Struct):
+    queries: list[QueryRequest]
 
 
-async def call_agent(url: str, tool_name: str, arguments: dict) -> dict:
-    """Call an MCP agent tool using FastMCP Client over SSE."""
-    async with Client(url) as client:
-        result = await client.call_tool(tool_name, arguments)
+def json_body(struct_type: type) -> Callable[[Request], Awaitable]:
+    """Dependency decoding the request body straight into a msgspec Struct —
+    one C-level pass instead of JSON parsing plus a pydantic validator chain."""
+    decoder = msgspec.json.Decoder(struct_type)
 
-        # FastMCP CallToolResult — extract text from .content list
-        if hasattr(result, "content"):
-            items = result.content
-        elif isinstance(result, list):
-            items = result
-        else:
-            # Last resort: stringify the whole result
-            items = [result]
-
-        # Get text from first content item
-        if items:
-            first = items[0]
-            if hasattr(first, "text"):
-                text = first.text
-            else:
-                text = str(first)
+    async def decode(request: Request):
+        try:
+            return decoder.decode(await request.body())
+        except (msgspec.DecodeError, msgspec.ValidationError) as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+    return decode
+
+
+# Comment-line keepalive interval, so proxies don't drop the stream during a long judge call
+SSE_PING_SECONDS = 15
+
+# The UI splits the stream on "\n"; ServerSentEvent defaults to "\r\n", so
+# every event and the response's pings are built with plain LF
+SSE_SEP = "\n"
+
+
+def sse_event(data: dict) -> ServerSentEvent:
+    """Build a named server-sent event, splicing in the agent's preserialized fields."""
+    payload = orjson.dumps(data)
+    if data["event"] in AGENT_EVENTS:
+        payload = b"{" + AGENTS[data["agent_key"]]["_static_json"] + b"," + payload[1:]
+    return ServerSentEvent(data=payload.decode(), event=data["event"], sep=SSE_SEP)
+
+
+_SESSION_LOCKS: dict = {}
+
+
+async def ensure_session(client: Client):
+    """Make sure the shared client holds its long-lived MCP session open.
+
+    Calls then run straight on the session, which multiplexes concurrent
+    requests. If the agent was down at startup or has dropped the session
+    (e.g. it restarted), the first caller to notice reconnects while the
+    others wait on the lock.
+    """
+    if client.is_connected():
+        return
+    async with _SESSION_LOCKS.setdefault(id(client), asyncio.Lock()):
+        if client.is_connected():
+            return
+        # A dropped session still counts our reference; reset it before reconnecting
+        try:
+            await client.close()
+        except Exception:
+            pass
+        await client.__aenter__()
+
+
+@app.on_event("startup")
+async def open_agent_clients():
+    """Open one long-lived MCP session per agent, shared by every request."""
+    urls = {key: cfg["url"] for key, cfg in AGENTS.items()}
+    urls["judge"] = JUDGE_URL
+    app.state.clients = {
+        key: Client(url, timeout=MCP_CALL_TIMEOUT, init_timeout=MCP_INIT_TIMEOUT)
+        for key, url in urls.items()
+    }
+
+    async def connect(key: str, client: Client):
+        try:
+            await ensure_session(client)
+        except Exception as e:
+            # Agent not up yet — call_agent will connect on first use
+            logger.warning("Could not pre-connect to %s agent: %s", key, e)
+
+    await asyncio.gather(*[connect(k, c) for k, c in app.state.clients.items()])
+
+
+@app.on_event("shutdown")
+async def close_agent_clients():
+    for client in app.state.clients.values():
+        await client.close()
+
+
+# tools/list results: tool name -> JSON input schema, refreshed every MCP_TOOLS_CACHE_TTL
+_TOOL_SCHEMAS: dict = {}
+
+JSON_TYPES = {
+    "string": str,
+    "object": dict,
+    "array": list,
+    "boolean": bool,
+    "integer": int,
+    "number": (int, float),
+}
+
+
+async def load_tool_schemas():
+    """Fetch tools/list from every agent concurrently into _TOOL_SCHEMAS."""
+    async def list_tools(key: str, client: Client):
+        try:
+            await ensure_session(client)
+            tools = await client.list_tools()
+        except Exception as e:
+            logger.warning("Could not list tools for %s agent: %s", key, e)
+            return
+        for tool in tools:
+            _TOOL_SCHEMAS[tool.name] = tool.inputSchema
+
+    await asyncio.gather(*[list_tools(k, c) for k, c in app.state.clients.items()])
+    logger.info("🧰 Cached schemas for %d MCP tools", len(_TOOL_SCHEMAS))
+
+
+async def refresh_tool_schemas():
+    while True:
+        await load_tool_schemas()
+        await asyncio.sleep(MCP_TOOLS_CACHE_TTL)
+
+
+@app.on_event("startup")
+async def start_tool_schema_refresh():
+    app.state.tool_schemas = _TOOL_SCHEMAS
+    app.state.tool_refresh = asyncio.create_task(refresh_tool_schemas())
+
+
+@app.on_event("shutdown")
+async def stop_tool_schema_refresh():
+    app.state.tool_refresh.cancel()
+
+
+def validate_arguments(tool_name: str, arguments: dict):
+    """Check arguments against the cached input schema, so a bad call fails
+    locally instead of after a network round-trip. Unknown tools pass."""
+    schema = _TOOL_SCHEMAS.get(tool_name)
+    if schema is None:
+        return
+    properties = schema.get("properties", {})
+
+    missing = [name for name in schema.get("required", []) if name not in arguments]
+    if missing:
+        raise ValueError(f"{tool_name}: missing required arguments {missing}")
+
+    for name, value in arguments.items():
+        if name not in properties:
+            if schema.get("additionalProperties") is False:
+                raise ValueError(f"{tool_name}: unexpected argument '{name}'")
+            continue
+        expected = JSON_TYPES.get(properties[name].get("type"))
+        if expected and not isinstance(value, expected):
+            raise ValueError(
+                f"{tool_name}: argument '{name}' should be {properties[name]['type']}, "
+                f"got {type(value).__name__}"
+            )
+
+
+TokenCallback = Callable[[str], Awaitable[None]]
+
+
+def load_inproc_tools() -> dict:
+    """Import the agent servers and return their tool functions by tool name."""
+    from mcp_servers.performance_agent import server as performance
+    from mcp_servers.cost_agent import server as cost
+    from mcp_servers.security_agent import server as security
+    from mcp_servers.judge_agent import server as judge
+
+    tools = [
+        performance.analyze_sql_performance,
+        performance.analyze_sql_all,
+        cost.analyze_sql_cost,
+        security.analyze_sql_security,
+        judge.judge_sql_results,
+    ]
+    # @mcp.tool wraps the function in a FunctionTool; call the original
+    return {tool.name: tool.fn for tool in tools}
+
+
+_INPROC_TOOLS = load_inproc_tools() if INPROC_AGENTS else {}
+
+
+class InprocContext:
+    """Stands in for the FastMCP Context of an in-process tool call,
+    forwarding report_progress messages as tokens."""
+
+    def __init__(self, on_token: Optional[TokenCallback]):
+        self.on_token = on_token
+
+    async def report_progress(self, progress: float, total: Optional[float] = None, message: Optional[str] = None):
+        if message and self.on_token is not None:
+            await self.on_token(message)
+
+
+class JsonMemberStream:
+    """Incrementally scans a streamed JSON object and returns each top-level
+    member as soon as its value is complete."""
+
+    def __init__(self):
+        self._text = ""
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._member_start = None
+
+    @property
+    def current_key(self) -> Optional[str]:
+        """Key of the top-level member currently being streamed, once known."""
+        if self._member_start is None:
+            return None
+        parts = self._text[self._member_start:].split('"', 2)
+        return parts[1] if len(parts) == 3 else None
+
+    def feed(self, delta: str) -> list:
+        """Append a chunk; return (key, value) pairs for members it completed."""
+        offset = len(self._text)
+        self._text += delta
+        members = []
+        for i, ch in enumerate(delta, offset):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._member_start = i + 1
+            elif self._depth == 1 and ch in ",}":
+                member = self._text[self._member_start:i]
+                if member.strip():
+                    try:
+                        members.extend(orjson.loads("{" + member + "}").items())
+                    except orjson.JSONDecodeError:
+                        pass  # The full response is parsed again at the end
+                self._member_start = i + 1
+                if ch == "}":
+                    self._depth = 0
+                    self._member_start = None
+            elif ch in "}]":
+                self._depth -= 1
+        return members
+
+
+def is_transient(error: Exception) -> bool:
+    """True for timeouts, transport failures and 5xx responses. fastmcp wraps
+    connect failures (agent down or restarting) in a RuntimeError, with the
+    httpx error as its cause, so the cause is checked too."""
+    for e in (error, error.__cause__):
+        if isinstance(e, (asyncio.TimeoutError, httpx.TransportError)):
+            return True
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code >= 500:
+            return True
+    return False
+
+
+async def await_call(call: asyncio.Task, streaming: asyncio.Event, timeout: float):
+    """Await an agent call within `timeout`, unless it starts streaming tokens
+    first — a streaming call isn't hung, so it gets the full MCP_CALL_TIMEOUT."""
+    start = time.monotonic()
+    first_token = asyncio.create_task(streaming.wait())
+    try:
+        done, _ = await asyncio.wait(
+            {call, first_token}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if call in done:
+            return call.result()
+        if not done:
+            raise asyncio.TimeoutError()
+        return await asyncio.wait_for(call, MCP_CALL_TIMEOUT - (time.monotonic() - start))
+    finally:
+        first_token.cancel()
+        call.cancel()
+
+
+async def call_agent(
+    client: Client,
+    tool_name: str,
+    arguments: dict,
+    on_token: Optional[TokenCallback] = None
+) -> dict:
+    """Call an MCP agent tool over a shared FastMCP Client session.
+
+    Agents stream LLM tokens as MCP progress notifications; each token is
+    passed to `on_token` while the call is still running. Timeouts,
+    transport failures and 5xx responses are retried with jittered
+    exponential backoff; tool and parse errors are not. Once an attempt
+    has streamed a token it is neither cut off early nor retried, since a
+    second attempt's tokens would be appended to the first one's.
+    """
+    validate_arguments(tool_name, arguments)
+
+    inproc_tool = _INPROC_TOOLS.get(tool_name)
+    if inproc_tool is not None:
+        return await inproc_tool(**arguments, ctx=InprocContext(on_token))
+
+    for attempt in range(MCP_MAX_ATTEMPTS):
+        timeout = MCP_FIRST_ATTEMPT_TIMEOUT if attempt == 0 else MCP_CALL_TIMEOUT
+        streaming = asyncio.Event()
+
+        async def on_attempt_token(delta: str):
+            streaming.set()
+            await on_token(delta)
+
+        call = asyncio.create_task(call_agent_once(
+            client, tool_name, arguments, on_attempt_token if on_token is not None else None
+        ))
+        try:
+            return await await_call(call, streaming, timeout)
+        except Exception as e:
+            if streaming.is_set() or not is_transient(e) or attempt == MCP_MAX_ATTEMPTS - 1:
+                raise
+            backoff = random.uniform(0.5, 1.0) * (2 ** attempt)
+            logger.warning(
+                "🔁 %s attempt %d failed (%s: %s); retrying in %.1fs",
+                tool_name, attempt + 1, type(e).__name__, e, backoff
+            )
+            await asyncio.sleep(backoff)
+
+
+async def call_agent_once(
+    client: Client,
+    tool_name: str,
+    arguments: dict,
+    on_token: Optional[TokenCallback] = None
+) -> dict:
+    """Single attempt of call_agent."""
+    async def forward_progress(progress: float, total: Optional[float], message: Optional[str]):
+        if message:
+            await on_token(message)
+
+    progress_handler = forward_progress if on_token is not None else None
+
+    await ensure_session(client)
+    result = await client.call_tool(tool_name, arguments, progress_handler=progress_handler)
+
+    # Dict-returning tools also send structuredContent, already decoded with
+    # the JSON-RPC envelope — use it instead of parsing the text copy again
+    structured = getattr(result, "structured_content", None)
+    if isinstance(structured, dict):
+        return structured
+
+    # FastMCP CallToolResult — extract text from .content list
+    if hasattr(result, "content"):
+        items = result.content
+    elif isinstance(result, list):
+        items = result
+    else:
+        # Last resort: stringify the whole result
+        items = [result]
+
+    # Get text from first content item
+    if items:
+        first = items[0]
+        if hasattr(first, "text"):
+            text = first.text
         else:
-            raise ValueError("Empty response from agent")
+            text = str(first)
+    else:
+        raise ValueError("Empty response from agent")
+
+    return parse_json_text(text)
+
+
+def parse_json_text(text: str) -> dict:
+    """Parse a tool's JSON reply. Plain JSON is parsed in a single pass; only
+    markdown-fenced or prose-wrapped replies take the extract path."""
+    try:
+        # orjson skips surrounding whitespace itself and fails at the first
+        # byte of non-JSON, so no strip() copy or prefix check is needed
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
 
-        # Parse JSON
-        text = text.strip()
+    # The outermost braces already exclude any ```json fence around the
+    # object, so two C-level scans replace the fence-stripping regexes
+    start = text.find("{")
+    end = text.rfind("}") + 1
+    if start >= 0 and end > start:
         try:
-            return json.loads(text)
-        except json.JSONDecodeError:
-            start = text.find("{")
-            end = text.rfind("}") + 1
-            if start >= 0 and end > start:
-                return json.loads(text[start:end])
-            raise ValueError(f"Could not parse JSON from response: {text[:300]}")
+            return orjson.loads(text[start:end])
+        except orjson.JSONDecodeError:
+            pass
+    raise ValueError(f"Could not parse JSON from response: {text.strip()[:300]}")
 
 
-async def run_agent(agent_key: str, query: str, dialect: str) -> tuple:
+async def run_agent(
+    client: Client,
+    agent_key: str,
+    query: str,
+    dialect: str,
+    on_token: Optional[TokenCallback] = None
+) -> tuple:
     """Run a single agent and return (key, result, elapsed_time)."""
     agent = AGENTS[agent_key]
-    start = time.time()
-    result = await call_agent(
-        agent["url"],
-        agent["tool"],
-        {"query": query, "dialect": dialect}
+    ck = agent_cache_key(agent_key, dialect, query)
+
+    # Concurrent identical calls wait on the first one, then hit the cache.
+    # The entry counts its holder and waiters, and is dropped with the last.
+    entry = _AGENT_LOCKS.setdefault(ck, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            cached = _AGENT_CACHE.get(ck)
+            if cached is not None:
+                return agent_key, {**cached, "cache_hit": True}, 0.0
+
+            start = time.monotonic_ns()
+            result = await call_agent(
+                client,
+                agent["tool"],
+                {"query": query, "dialect": dialect},
+                on_token
+            )
+            elapsed = elapsed_since(start)
+            if "error" not in result:
+                _AGENT_CACHE.set(ck, result)
+            return agent_key, result, elapsed
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and _AGENT_LOCKS.get(ck) is entry:
+            del _AGENT_LOCKS[ck]
+
+
+async def settle_agent(
+    client: Client,
+    agent_key: str,
+    query: str,
+    dialect: str,
+    on_token: Optional[TokenCallback] = None
+) -> tuple:
+    """Like run_agent, but returns (key, result, elapsed, error) instead of raising."""
+    try:
+        return (*await run_agent(client, agent_key, query, dialect, on_token), None)
+    except Exception as e:
+        return agent_key, None, None, e
+
+
+SEVERITY_RANK = {"critical": 4, "high": 3, "medium": 2, "low": 1}
+HEALTH_BY_SEVERITY = {4: "Poor", 3: "Poor", 2: "Fair", 1: "Good", 0: "Good"}
+
+# Each agent's list of applied changes, for the consensus verdict's improvements
+CHANGE_FIELDS = {
+    "performance": "changes_made",
+    "cost": "savings_explanation",
+    "security": "security_improvements",
+}
+
+def canonical_sql(sql: str) -> str:
+    """Whitespace-, case- and trailing-semicolon-insensitive form for comparing rewrites."""
+    return _WHITESPACE.sub(" ", sql).strip().rstrip(";").strip().lower()
+
+
+# Near-identical rewrites: max pairwise edit distance of their canonical forms
+CONSENSUS_MAX_EDIT_DISTANCE = 10
+CONSENSUS_BLOCKING_SEVERITY = SEVERITY_RANK["high"]
+
+
+def consensus_verdict(query: str, results: dict) -> Optional[dict]:
+    """Build a judge-shaped verdict locally when the agents that ran all wrote
+    the same SQL, or near-identical SQL with no high/critical findings.
+
+    With nothing to synthesize, the judge LLM call would only restate the
+    agreement. Triage-skipped agents cast no vote, and it takes at least two
+    real reports to agree. Returns None when there is no consensus.
+    """
+    if set(results) != set(AGENTS) or any("error" in r for r in results.values()):
+        return None
+    voters = [k for k in AGENTS if not results[k].get("skipped")]
+    if len(voters) < 2:
+        return None
+    rewrites = [canonical_sql(results[k].get("rewritten_sql") or "") for k in voters]
+    if not all(rewrites):
+        return None
+
+    def severity(agent_key: str) -> int:
+        return SEVERITY_RANK.get(str(results[agent_key].get("severity", "")).lower(), 0)
+
+    # Rewrites that differ only trivially (alias case, a LIMIT value, ...) still
+    # count as agreement, unless an agent found a serious problem the judge
+    # should weigh in on
+    exact = len(set(rewrites)) == 1
+    if not exact:
+        if max(map(severity, voters)) >= CONSENSUS_BLOCKING_SEVERITY:
+            return None
+        distance = max(
+            Levenshtein.distance(a, b, score_cutoff=CONSENSUS_MAX_EDIT_DISTANCE)
+            for a, b in combinations(rewrites, 2)
+        )
+        if distance >= CONSENSUS_MAX_EDIT_DISTANCE:
+            return None
+
+    # The agent that found the most severe problem gets the credit
+    winner_key = max(voters, key=severity)
+    winner = AGENTS[winner_key]["label"]
+    final_sql = results[winner_key]["rewritten_sql"]
+    unchanged = canonical_sql(final_sql) == canonical_sql(query)
+    same = "the same" if exact else "essentially the same"
+    agents = "All three agents" if len(voters) == 3 else "Both agents that ran"
+    names = " and ".join(AGENTS[k]["label"].split(" Agent")[0] for k in voters)
+
+    improvements = [
+        f"{change} (from {AGENTS[k]['label']})"
+        for k in voters
+        for change in results[k].get(CHANGE_FIELDS[k], [])[:2]
+    ][:5]
+
+    return {
+        "winner": winner,
+        "winner_reason": f"{agents} independently produced {same} SQL; "
+                         f"{winner} identified the most severe issue.",
+        "scores": {
+            AGENTS[k]["label"]: {"score": 10, "comment": "Matched the consensus rewrite"}
+            for k in voters
+        },
+        "verdict": f"{agents} converged on {same} rewrite, so there was nothing "
+                   "to arbitrate. The consensus SQL is the final answer.",
+        "final_sql": final_sql,
+        "final_sql_explanation": f"{'Identical' if exact else 'Near-identical'} rewrite proposed "
+                                 f"by the {names} agents.",
+        "top_improvements": improvements,
+        "overall_query_health": "Excellent" if unchanged else HEALTH_BY_SEVERITY[severity(winner_key)],
+        "consensus": True,
+        "agent": "Judge Agent ⚖️",
+        "model": "consensus (no LLM call)",
+        "tokens_used": 0,
+        "cost_usd": 0.0,
+    }
+
+
+async def fused_agents(
+    client: Client,
+    query: str,
+    dialect: str,
+    settle: Callable[[tuple], Awaitable[None]],
+    on_token: Callable[[str, str], Awaitable[None]]
+):
+    """Run all 3 agents as one fused LLM call, settling each agent as soon as
+    its section of the streamed JSON is complete."""
+    start = time.monotonic_ns()
+    unsettled = list(AGENTS.keys())
+    settled: dict = {}
+    members = JsonMemberStream()
+
+    async def settle_section(agent_key: str, result: dict):
+        unsettled.remove(agent_key)
+        settled[agent_key] = result
+        if "error" not in result:
+            _AGENT_CACHE.set(agent_cache_key(agent_key, dialect, query), result)
+        await settle((agent_key, result, elapsed_since(start), None))
+
+    async def on_fused_token(delta: str):
+        streaming_key = members.current_key
+        if streaming_key in AGENTS:
+            await on_token(streaming_key, delta)
+        for agent_key, result in members.feed(delta):
+            if agent_key in unsettled and isinstance(result, dict):
+                await settle_section(agent_key, result)
+
+    try:
+        combined = await call_agent(
+            client, FUSED_TOOL, {"query": query, "dialect": dialect}, on_fused_token
+        )
+    except Exception as e:
+        for agent_key in list(unsettled):
+            unsettled.remove(agent_key)
+            await settle((agent_key, None, None, e))
+        return
+
+    # Sections settled from the stream carry no usage, which only comes with
+    # the full reply; fill it into the reports (and cache entries) in place
+    for agent_key, result in settled.items():
+        section = combined.get(agent_key)
+        if isinstance(section, dict):
+            for field in ("tokens_used", "cost_usd"):
+                if field in section:
+                    result[field] = section[field]
+
+    # Sections the incremental scan missed (e.g. markdown-wrapped output)
+    for agent_key in list(unsettled):
+        result = combined.get(agent_key)
+        if isinstance(result, dict):
+            await settle_section(agent_key, result)
+        else:
+            unsettled.remove(agent_key)
+            error = combined.get("error", f"Fused response has no '{agent_key}' section")
+            await settle((agent_key, None, None, RuntimeError(error)))
+
+
+# Local triage: signals that give an agent something to look at. Checked
+# before any tokens are spent, so an agent with nothing to find is skipped.
+_HAS_FROM = re.compile(r"\bFROM\b", re.I)
+_SECURITY_SIGNALS = re.compile(
+    r"""['"$?*;]|--|/\*|%s"""                                         # literals, placeholders, SELECT *, stacked statements, comments
+    r"|\b(?:UNION|EXEC(?:UTE)?|PREPARE|GRANT|REVOKE|INTO|DROP|DELETE|UPDATE|INSERT|ALTER|TRUNCATE)\b"
+    r"|\b(?:xp_\w+|sp_\w+|pg_\w+|lo_import|lo_export|load_file|dblink\w*|sleep|benchmark|waitfor)\b"  # server/file access, timing probes
+    r"|\b0x[0-9a-f]"                                                    # hex-encoded literals
+    r"|pass(?:word|wd)?|ssn|secret|token|credit|card|email|phone|birth|salary|address",  # PII-looking names
+    re.I
+)
+
+# Security has the narrowest scope of the three; cost needs something to scan
+TRIAGE_RULES = {
+    "cost": _HAS_FROM,
+    "security": _SECURITY_SIGNALS,
+}
+
+TRIAGE_FINDINGS = {
+    "performance": ("issues_found", "changes_made"),
+    "cost": ("expensive_operations", "savings_explanation"),
+    "security": ("vulnerabilities", "security_improvements"),
+}
+
+
+def _should_run(agent_key: str, query: str) -> bool:
+    """False if local triage finds nothing in the query for this agent to analyze."""
+    rule = TRIAGE_RULES.get(agent_key)
+    return rule is None or rule.search(query) is not None
+
+
+def skipped_report(agent_key: str, query: str) -> dict:
+    """Agent-shaped "no issues" report for an agent skipped by triage."""
+    findings, changes = TRIAGE_FINDINGS[agent_key]
+    return {
+        "agent": AGENTS[agent_key]["label"],
+        "model": "triage (no LLM call)",
+        "skipped": True,
+        "severity": "low",
+        "rewritten_sql": query,
+        findings: [],
+        changes: [],
+        "tokens_used": 0,
+        "cost_usd": 0.0,
+    }
+
+
+def pending_report(agent_key: str, query: str) -> dict:
+    """Stand-in for an agent report that hasn't arrived yet."""
+    return {
+        "agent": AGENTS[agent_key]["label"],
+        "pending": True,
+        "rewritten_sql": query,
+        "issues_found": ["Report still running — judge on the other two agents"],
+    }
+
+
+async def call_judge(
+    client: Client,
+    query: str,
+    results: dict,
+    on_token: Optional[TokenCallback] = None
+) -> dict:
+    """Ask the Judge Agent for a verdict, with a placeholder for any missing report."""
+    # Trimmed to the judge's fields and serialized once here, so the judge
+    # embeds the JSON without a decode/re-encode round-trip
+    reports = {k: results.get(k) or pending_report(k, query) for k in AGENTS}
+    return await call_agent(
+        client,
+        "judge_sql_results",
+        {
+            "original_query": query,
+            "performance_report_json": slim_report(reports["performance"]),
+            "cost_report_json": slim_report(reports["cost"]),
+            "security_report_json": slim_report(reports["security"])
+        },
+        on_token
     )
-    elapsed = round(time.time() - start, 2)
-    return agent_key, result, elapsed
 
 
-async def stream_race(query: str, dialect: str) -> AsyncGenerator[str, None]:
-    """Core race logic — runs all agents in parallel and streams SSE events."""
+def without_score(verdict: dict, agent_key: str) -> dict:
+    """Drop the score a preliminary verdict gave `agent_key`, which the judge
+    only saw as a pending placeholder."""
+    label = AGENTS[agent_key]["label"]
+    return {
+        **verdict,
+        "scores": {k: v for k, v in verdict.get("scores", {}).items() if k != label},
+        "unscored_agent": label,
+    }
 
-    race_start = time.time()
 
-    yield sse_event({
+def materially_differs(query: str, results: dict, agent_key: str) -> bool:
+    """True if an agent's report could change a verdict judged without it: it
+    proposes SQL no other agent wrote, or finds a more severe problem."""
+    def severity(report: dict) -> int:
+        return SEVERITY_RANK.get(str(report.get("severity", "")).lower(), 0)
+
+    report = results[agent_key]
+    others = [r for k, r in results.items() if k != agent_key]
+    known_sql = {canonical_sql(query)} | {canonical_sql(r.get("rewritten_sql") or "") for r in others}
+    return (
+        canonical_sql(report.get("rewritten_sql") or "") not in known_sql
+        or severity(report) > max(map(severity, others), default=0)
+    )
+
+
+def race_start_event(
+    query: str,
+    dialect: str,
+    message: str = "🏁 Race started! 3 agents analyzing your SQL simultaneously..."
+) -> dict:
+    return {
         "event": "race_start",
-        "message": "🏁 Race started! 3 agents analyzing your SQL simultaneously...",
+        "started_at": time.time(),
+        "message": message,
         "query_preview": query[:100] + ("..." if len(query) > 100 else ""),
         "dialect": dialect,
-    })
+    }
+
+
+class RaceBroadcast:
+    """One in-flight race, streamed to every request for the same query.
+
+    The race runs in its own task and records each event, so a request
+    that arrives mid-race replays what it missed and then follows live.
+    Every event is kept for the life of the race; a subscriber that falls
+    behind gets the token deltas it missed merged into one event per run
+    of an agent's tokens. The race is cancelled once no subscriber is left.
+    """
+
+    def __init__(self, key: str, events: AsyncGenerator[dict, None]):
+        self.key = key
+        self.events: list = []
+        self.finished = False
+        self._changed = asyncio.Event()
+        self._subscribers = 0
+        self._task = asyncio.create_task(self._produce(events))
+
+    def _publish(self, event: dict):
+        self.events.append(event)
+        # Wake everyone waiting on the current event; later waits get a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _produce(self, events: AsyncGenerator[dict, None]):
+        try:
+            async for event in events:
+                self._publish(event)
+
+            if is_clean_race(self.events):
+                # Token deltas and preliminary verdicts are only useful live;
+                # replays jump straight to the results
+                _VERDICT_CACHE.set(
+                    self.key, [e for e in self.events if e["event"] not in LIVE_ONLY_EVENTS]
+                )
+        except Exception as e:
+            # Subscribers still get a terminal event instead of a silent end
+            logger.error("Race failed: %s", e)
+            self._publish({"event": "judge_error", "error": str(e), "message": "Race failed."})
+            self._publish({"event": "done"})
+        finally:
+            _INFLIGHT.pop(self.key, None)
+            self.finished = True
+            self._changed.set()
+
+    async def subscribe(self) -> AsyncGenerator[dict, None]:
+        self._subscribers += 1
+        try:
+            sent = 0
+            while True:
+                while sent < len(self.events):
+                    event = self.events[sent]
+                    sent += 1
+                    if event["event"] == "agent_token":
+                        # Behind the race: merge the agent's queued deltas
+                        deltas = [event["delta"]]
+                        while (
+                            sent < len(self.events)
+                            and self.events[sent]["event"] == "agent_token"
+                            and self.events[sent]["agent_key"] == event["agent_key"]
+                        ):
+                            deltas.append(self.events[sent]["delta"])
+                            sent += 1
+                        if len(deltas) > 1:
+                            event = {**event, "delta": "".join(deltas)}
+                    yield event
+                if self.finished:
+                    return
+                await self._changed.wait()
+        finally:
+            self._subscribers -= 1
+            if self._subscribers == 0 and not self.finished:
+                # Every client went away mid-race — don't leave agent calls running
+                self._task.cancel()
+
+
+async def stream_race(
+    query: str,
+    dialect: str,
+    clients: dict,
+    canonical_query: str
+) -> AsyncGenerator[ServerSentEvent, None]:
+    """Stream a race as SSE, replaying a cached race for repeated queries.
+
+    Races are cached under the parser-canonical form of the query, so
+    whitespace- and case-only variants share an entry. Concurrent identical
+    requests attach to the race already in flight and stream it live
+    instead of starting their own.
+    """
+    # First byte goes out before any cache lookup or task setup
+    yield sse_event(race_start_event(query, dialect))
+
+    key = cache_key(dialect, canonical_query)
+
+    cached = _VERDICT_CACHE.get(key)
+    if cached is not None:
+        logger.info("⚡ Verdict cache hit — replaying previous race")
+        for event in cached:
+            yield sse_event({**event, "cache_hit": True})
+        return
+
+    # No await between the lookup and the claim, so no lock is needed
+    broadcast = _INFLIGHT.get(key)
+    if broadcast is None:
+        broadcast = _INFLIGHT[key] = RaceBroadcast(key, race(query, dialect, clients))
+    else:
+        logger.info("⏳ Identical race in flight — attaching to its stream")
+
+    # aclosing: a disconnecting client unsubscribes right away, not at GC
+    async with aclosing(broadcast.subscribe()) as events:
+        async for event in events:
+            yield sse_event(event)
+
+
+def is_clean_race(events: list) -> bool:
+    """True if every agent and the judge succeeded — failures are retried, not replayed."""
+    verdicts = [e for e in events if e["event"] == "verdict"]
+    if not verdicts or verdicts[0]["had_errors"] or "error" in verdicts[0]["verdict"]:
+        return False
+    return not any(
+        e["event"] == "agent_done" and "error" in e["result"] for e in events
+    )
+
+
+async def race(query: str, dialect: str, clients: dict) -> AsyncGenerator[dict, None]:
+    """Core race logic — runs all agents in parallel and yields event dicts."""
+
+    race_start = time.monotonic_ns()
 
     results = {}
     errors = {}
 
-    # Create all 3 agent tasks to run simultaneously
-    tasks = {
-        agent_key: asyncio.create_task(run_agent(agent_key, query, dialect))
-        for agent_key in AGENTS.keys()
-    }
+    # Token events, agent settlements (key, result, elapsed, error) and the
+    # finished judge task are merged through one bounded queue so the stream
+    # can interleave live tokens with completions
+    updates: asyncio.Queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+    lagging_tokens: dict = {}
+
+    async def emit_token(agent_key: str, delta: str):
+        # Never await here: this runs inside the MCP session shared by every
+        # request. While the queue is full, deltas are coalesced into one event.
+        delta = lagging_tokens.pop(agent_key, "") + delta
+        if updates.qsize() < TOKEN_QUEUE_LIMIT:
+            updates.put_nowait({"event": "agent_token", "agent_key": agent_key, "delta": delta})
+        else:
+            lagging_tokens[agent_key] = delta
+
+    def forward_tokens(agent_key: str) -> TokenCallback:
+        return lambda delta: emit_token(agent_key, delta)
 
-    pending = set(tasks.values())
-    task_to_key = {v: k for k, v in tasks.items()}
+    lagging_fields: dict = {}
 
-    while pending:
-        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    def forward_judge() -> TokenCallback:
+        """Forward judge tokens, plus each verdict field as soon as it has
+        streamed in full (winner, scores, final_sql, ...)."""
+        members = JsonMemberStream()
+
+        async def on_judge_token(delta: str):
+            await emit_token("judge", delta)
+            lagging_fields.update(members.feed(delta))
+            if lagging_fields and updates.qsize() < TOKEN_QUEUE_LIMIT:
+                updates.put_nowait({"event": "judge_partial", "fields": lagging_fields.copy()})
+                lagging_fields.clear()
+
+        return on_judge_token
+
+    async def race_agent(agent_key: str):
+        await updates.put(await settle_agent(
+            clients[agent_key], agent_key, query, dialect, forward_tokens(agent_key)
+        ))
+
+    if FUSED_AGENTS:
+        tasks = [asyncio.create_task(
+            fused_agents(clients["performance"], query, dialect, updates.put, emit_token)
+        )]
+    else:
+        # Run the agents that triage found work for simultaneously; the rest
+        # settle right away with a "no issues" report
+        tasks = []
+        for agent_key in AGENTS:
+            if _should_run(agent_key, query):
+                tasks.append(asyncio.create_task(race_agent(agent_key)))
+            else:
+                logger.info("⏭️ Triage: skipping %s", AGENTS[agent_key]['label'])
+                updates.put_nowait((agent_key, skipped_report(agent_key, query), 0.0, None))
 
-        for task in done:
-            agent_key = task_to_key[task]
+    # Judge call started on the first two reports while the third still runs
+    preliminary_task: Optional[asyncio.Task] = None
+    preliminary: Optional[dict] = None
+    pending_key: Optional[str] = None
+
+    try:
+        settled = 0
+        ran = 0  # Settled agents that actually ran, i.e. not skipped by triage
+        while settled < len(AGENTS):
+            update = await updates.get()
+            if isinstance(update, dict):
+                yield update
+                continue
+
+            if isinstance(update, asyncio.Task):
+                if update is not preliminary_task:
+                    continue  # A judge task that was already given up on
+                if update.exception() is None:
+                    preliminary = without_score(update.result(), pending_key)
+                    yield {
+                        "event": "preliminary_verdict",
+                        "verdict": preliminary,
+                        "pending_agent": AGENTS[pending_key]["label"],
+                        "total_elapsed": elapsed_since(race_start),
+                        "total_cost_usd": round(sum(
+                            r.get("cost_usd") or 0 for r in results.values()
+                        ) + (preliminary.get("cost_usd") or 0), 6),
+                    }
+                else:
+                    logger.warning("Preliminary judge failed: %s", update.exception())
+                    preliminary_task = None
+                continue
+
+            settled += 1
+            agent_key, result, elapsed, error = update
             agent_info = AGENTS[agent_key]
+            skipped = error is None and result.get("skipped", False)
+            if not skipped:
+                ran += 1
 
-            try:
-                _, result, elapsed = task.result()
+            if error is None:
                 results[agent_key] = result
 
-                yield sse_event({
-                    "event": "agent_done",
-                    "agent_key": agent_key,
-                    "agent_label": agent_info["label"],
-                    "agent_color": agent_info["color"],
-                    "elapsed": elapsed,
-                    "result": result,
-                    "position": len(results)
-                })
+                event = agent_info["_done_template"].copy()
+                event["elapsed"] = elapsed
+                event["result"] = result
+                event["position"] = None if skipped else ran
+                yield event
 
-                logger.info(f"✅ {agent_info['label']} finished in {elapsed}s")
+                logger.info("✅ %s finished in %ss", agent_info['label'], elapsed)
 
-            except Exception as e:
-                error_msg = str(e)
+            else:
+                error_msg = str(error)
                 errors[agent_key] = error_msg
-                logger.error(f"❌ {agent_info['label']} failed: {error_msg}")
+                logger.error("❌ %s failed: %s", agent_info['label'], error_msg)
 
                 results[agent_key] = {
                     "error": error_msg,
@@ -181,127 +1232,456 @@ async def stream_race(query: str, dialect: str) -> AsyncGenerator[str, None]:
                     "issues_found": [f"Agent error: {error_msg}"]
                 }
 
-                yield sse_event({
-                    "event": "agent_error",
-                    "agent_key": agent_key,
-                    "agent_label": agent_info["label"],
-                    "error": error_msg
-                })
+                event = agent_info["_error_template"].copy()
+                event["error"] = error_msg
+                yield event
 
-    # All agents done — call judge
-    all_elapsed = round(time.time() - race_start, 2)
+            # Fastest two of three are in: start judging them now, while the
+            # slowest agent is still running. Triage-skipped reports don't
+            # count, or a lone real report would set off the judge.
+            if settled < len(AGENTS) and ran == len(AGENTS) - 1 and not errors:
+                pending_key = next(k for k in AGENTS if k not in results)
+                preliminary_task = asyncio.create_task(
+                    call_judge(clients["judge"], query, results, forward_judge())
+                )
+                preliminary_task.add_done_callback(updates.put_nowait)
+                tasks.append(preliminary_task)
 
-    yield sse_event({
-        "event": "judging",
-        "message": "⚖️ All agents finished! Judge is reviewing reports...",
-        "agents_elapsed": all_elapsed
-    })
+        # All agents done — call judge
+        all_elapsed = elapsed_since(race_start)
+        verdict = consensus_verdict(query, results)
 
-    try:
-        judge_start = time.time()
-        verdict = await call_agent(
-            JUDGE_URL,
-            "judge_sql_results",
-            {
-                "original_query": query,
-                "performance_report": results.get("performance", {}),
-                "cost_report": results.get("cost", {}),
-                "security_report": results.get("security", {})
+        # Keep the preliminary verdict unless the last report changes the picture
+        judge_task = None
+        if preliminary_task is not None:
+            last_key = update[0]
+            failed = preliminary_task.done() and preliminary_task.exception() is not None
+            if verdict is None and not errors and not failed and not materially_differs(query, results, last_key):
+                logger.info("🤝 %s adds nothing new — keeping the preliminary verdict", AGENTS[last_key]['label'])
+                judge_task = preliminary_task
+            else:
+                preliminary_task.remove_done_callback(updates.put_nowait)
+                preliminary_task.cancel()
+                preliminary = None
+
+        yield {
+            "event": "judging",
+            "message": "⚖️ All agents agree — no judging needed!" if verdict
+                       else "⚖️ All agents finished! Judge is reviewing reports...",
+            "agents_elapsed": all_elapsed
+        }
+
+        try:
+            judge_start = time.monotonic_ns()
+            judge_key = None
+            # A kept preliminary judge saw a placeholder for the last report, so
+            # its verdict is neither looked up nor cached under the key of all three
+            if verdict is None and not errors and judge_task is None:
+                # Same three reports (e.g. all agent cache hits) -> same verdict
+                judge_key = judge_cache_key(query, results)
+                cached = _JUDGE_CACHE.get(judge_key)
+                if cached is not None:
+                    logger.info("⚡ Judge cache hit — reusing previous verdict")
+                    verdict = {**cached, "cache_hit": True}
+
+            if verdict is None and preliminary is not None:
+                verdict = preliminary
+            elif verdict is None:
+                if judge_task is None:
+                    judge_task = asyncio.create_task(
+                        call_judge(clients["judge"], query, results, forward_judge())
+                    )
+                    judge_task.add_done_callback(updates.put_nowait)
+                    tasks.append(judge_task)
+
+                # A discarded preliminary judge can finish just before it is
+                # cancelled, leaving its task in the queue — skip it
+                while (update := await updates.get()) is not judge_task:
+                    if not isinstance(update, asyncio.Task):
+                        yield update
+
+                verdict = judge_task.result()
+                if judge_task is preliminary_task:
+                    verdict = without_score(verdict, pending_key)
+                if judge_key is not None and "error" not in verdict:
+                    _JUDGE_CACHE.set(judge_key, verdict)
+            elif verdict.get("consensus"):
+                logger.info("🤝 All agents agree — skipping the judge LLM call")
+
+            if FUSED_AGENTS:
+                # The fused call's usage arrives just after its last section
+                # settles; wait for it so the total includes the agents' cost
+                await tasks[0]
+
+            judge_elapsed = elapsed_since(judge_start)
+            total_elapsed = elapsed_since(race_start)
+
+            total_cost = sum([
+                results.get(k, {}).get("cost_usd") or 0
+                for k in ["performance", "cost", "security"]
+            ]) + (verdict.get("cost_usd") or 0)
+
+            yield {
+                "event": "verdict",
+                "verdict": verdict,
+                "judge_elapsed": judge_elapsed,
+                "total_elapsed": total_elapsed,
+                "total_cost_usd": round(total_cost, 6),
+                "had_errors": bool(errors)
             }
-        )
-        judge_elapsed = round(time.time() - judge_start, 2)
-        total_elapsed = round(time.time() - race_start, 2)
 
-        total_cost = sum([
-            results.get(k, {}).get("cost_usd", 0)
-            for k in ["performance", "cost", "security"]
-        ]) + verdict.get("cost_usd", 0)
+            logger.info("🏆 Race complete in %ss. Winner: %s", total_elapsed, verdict.get('winner', 'unknown'))
 
-        yield sse_event({
-            "event": "verdict",
-            "verdict": verdict,
-            "judge_elapsed": judge_elapsed,
-            "total_elapsed": total_elapsed,
-            "total_cost_usd": round(total_cost, 6),
-            "had_errors": bool(errors)
-        })
+        except Exception as e:
+            logger.error("Judge failed: %s", e)
+            yield {
+                "event": "judge_error",
+                "error": str(e),
+                "message": "Judge encountered an error."
+            }
+    finally:
+        # Client went away mid-race — don't leave agent calls running
+        for task in tasks:
+            task.cancel()
 
-        logger.info(f"🏆 Race complete in {total_elapsed}s. Winner: {verdict.get('winner', 'unknown')}")
+    yield {"event": "done"}
 
-    except Exception as e:
-        logger.error(f"Judge failed: {e}")
-        yield sse_event({
-            "event": "judge_error",
-            "error": str(e),
-            "message": "Judge encountered an error."
-        })
 
+def trivial_verdict(query: str) -> dict:
+    """Judge-shaped verdict for SQL that reads no tables and calls no functions —
+    nothing to optimize."""
+    return {
+        "winner": "None",
+        "winner_reason": "The query reads no tables and calls no functions, "
+                         "so there is nothing to optimize.",
+        "scores": {
+            agent["label"]: {"score": 10, "comment": "Not needed"}
+            for agent in AGENTS.values()
+        },
+        "verdict": "This query doesn't touch any tables or call any functions, so it has no "
+                   "performance, cost or security surface for the agents to improve. "
+                   "No agents were run.",
+        "final_sql": query,
+        "final_sql_explanation": "Unchanged — the original query is already minimal.",
+        "top_improvements": [],
+        "overall_query_health": "Excellent",
+        "agent": "Judge Agent ⚖️",
+        "model": "sqlglot (no LLM call)",
+        "tokens_used": 0,
+        "cost_usd": 0.0,
+    }
+
+
+async def stream_trivial(query: str, dialect: str) -> AsyncGenerator[ServerSentEvent, None]:
+    """Answer a trivial query locally without starting a race."""
+    yield sse_event(race_start_event(
+        query, dialect, "🏁 No tables or function calls — nothing for the agents to race on."
+    ))
+    yield sse_event({"event": "judging", "message": "⚖️ Skipping the agents.", "agents_elapsed": 0.0})
+    yield sse_event({
+        "event": "verdict",
+        "verdict": trivial_verdict(query),
+        "judge_elapsed": 0.0,
+        "total_elapsed": 0.0,
+        "total_cost_usd": 0.0,
+        "had_errors": False
+    })
     yield sse_event({"event": "done"})
 
 
+def parse_statements(query: str, read: Optional[str]) -> list:
+    """Parse SQL with sqlglot, turning parse failures into 400s."""
+    try:
+        statements = [s for s in sqlglot.parse(query, read=read) if s is not None]
+    except SqlglotError as e:
+        # ParseError's message highlights the offending token with terminal escapes
+        errors = getattr(e, "errors", None)
+        message = errors[0]["description"] if errors else str(e)
+        raise HTTPException(status_code=400, detail=f"SQL parse error: {message}")
+    if not statements:
+        raise HTTPException(status_code=400, detail="Query contains no SQL statements")
+    return statements
+
+
+def is_trivial(statement: exp.Expression) -> bool:
+    """True for a plain query that reads no tables and calls no functions,
+    e.g. SELECT 1. Commands, EXEC and function calls such as pg_read_file()
+    or load_file() can still reach the server, so they always get a race."""
+    return isinstance(statement, exp.Query) and statement.find(exp.Table, exp.Func) is None
+
+
 @app.post("/analyze")
-async def analyze(req: QueryRequest):
+async def analyze(req: QueryRequest = Depends(json_body(QueryRequest))):
     """Stream SQL analysis from all 3 agents + judge verdict."""
-    if not req.query.strip():
+    query = req.query.strip()
+    if not query:
         raise HTTPException(status_code=400, detail="Query cannot be empty")
     if len(req.query) > 10000:
         raise HTTPException(status_code=400, detail="Query too long (max 10,000 chars)")
 
-    return StreamingResponse(
-        stream_race(req.query.strip(), req.dialect),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "X-Accel-Buffering": "no",
-            "Connection": "keep-alive"
-        }
-    )
+    # Parse locally first: malformed SQL fails in microseconds instead of
+    # after four LLM round-trips
+    read = SQLGLOT_DIALECTS.get(req.dialect.lower())
+    statements = parse_statements(query, read)
+
+    if all(is_trivial(s) for s in statements):
+        events = stream_trivial(query, req.dialect)
+    else:
+        canonical = ";\n".join(s.sql(dialect=read, normalize=True) for s in statements)
+        events = stream_race(query, req.dialect, app.state.clients, canonical)
+
+    return EventSourceResponse(events, ping=SSE_PING_SECONDS, sep=SSE_SEP)
+
+
+async def probe_agent(key: str, client: Client) -> tuple:
+    """Ping one agent over its shared session; returns (key, "ok" or error)."""
+    async def ping():
+        await ensure_session(client)
+        await client.ping()
+
+    try:
+        await asyncio.wait_for(ping(), HEALTH_PROBE_TIMEOUT)
+        return key, "ok"
+    except Exception as e:
+        return key, f"error: {str(e) or type(e).__name__}"
+
+
+BATCH_MAX_QUERIES = 500
+BATCH_JUDGE_CONCURRENCY = 8
+
+# Judged batch results, so repeated polls don't re-run the judge
+_BATCH_RESULTS = TTLCache(CACHE_TTL, 64)
+# Judging tasks of completed batches, keyed by batch id, while they run
+_BATCH_JUDGING: dict = {}
+
+
+@app.post("/analyze-batch")
+async def analyze_batch(req: BatchRequest = Depends(json_body(BatchRequest))):
+    """Queue the agent analyses for many queries on the Batch API (half price,
+    delivered within the completion window). Poll GET /analyze-batch/{id}."""
+    from orchestrator import batch
+
+    if not req.queries:
+        raise HTTPException(status_code=400, detail="No queries given")
+    if len(req.queries) > BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"Too many queries (max {BATCH_MAX_QUERIES})")
+
+    queries = []
+    for item in req.queries:
+        query = item.query.strip()
+        if not query or len(query) > 10000:
+            raise HTTPException(status_code=400, detail="Each query must be 1-10,000 chars")
+        parse_statements(query, SQLGLOT_DIALECTS.get(item.dialect.lower()))
+        queries.append({"query": query, "dialect": item.dialect})
+
+    batch_id = await batch.submit_batch(queries)
+    return {"batch_id": batch_id, "status": "submitted", "count": len(queries)}
+
+
+async def judge_batch(batch_id: str, status: str, queries: list, reports: dict):
+    """Judge every query of a completed batch and cache the full response."""
+    judge_slots = asyncio.Semaphore(BATCH_JUDGE_CONCURRENCY)
+
+    async def judge_one(index: int, item: dict) -> dict:
+        query, dialect = item["query"], item["dialect"]
+        results = {}
+        for agent_key, agent in AGENTS.items():
+            result = reports.get(index, {}).get(agent_key) or {"error": "Missing from batch output"}
+            if "error" in result:
+                result = {
+                    **result,
+                    "agent": agent["label"],
+                    "rewritten_sql": query,
+                    "issues_found": [f"Agent error: {result['error']}"]
+                }
+            else:
+                # Live analyses of the same query can reuse the batch reports
+                _AGENT_CACHE.set(agent_cache_key(agent_key, dialect, query), result)
+            results[agent_key] = result
+
+        verdict = consensus_verdict(query, results)
+        if verdict is None:
+            async with judge_slots:
+                try:
+                    verdict = await call_judge(app.state.clients["judge"], query, results)
+                except Exception as e:
+                    logger.error("Batch judge failed: %s", e)
+                    verdict = {"error": str(e)}
+        return {"query": query, "dialect": dialect, "results": results, "verdict": verdict}
+
+    items = await asyncio.gather(*[judge_one(i, item) for i, item in enumerate(queries)])
+    _BATCH_RESULTS.set(batch_id, {"batch_id": batch_id, "status": status, "results": items})
+
+
+def batch_judged(batch_id: str, task: asyncio.Task):
+    _BATCH_JUDGING.pop(batch_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Judging batch %s failed: %s", batch_id, task.exception())
+
+
+@app.get("/analyze-batch/{batch_id}")
+async def analyze_batch_results(batch_id: str):
+    """Batch status, or — once the agents are done and the judge has run —
+    every query's reports and verdict."""
+    from openai import NotFoundError
+    from orchestrator import batch
+
+    cached = _BATCH_RESULTS.get(batch_id)
+    if cached is not None:
+        return cached
+    if batch_id in _BATCH_JUDGING:
+        return {"batch_id": batch_id, "status": "judging"}
+
+    try:
+        status, queries, reports = await batch.collect_batch(batch_id)
+    except (NotFoundError, KeyError):
+        raise HTTPException(status_code=404, detail="Unknown batch id")
+    if reports is None:
+        return {"batch_id": batch_id, "status": status}
+
+    # One judging task per batch, independent of the poll that started it, so
+    # concurrent or retried polls don't judge the batch again
+    if batch_id not in _BATCH_JUDGING and _BATCH_RESULTS.get(batch_id) is None:
+        task = asyncio.create_task(judge_batch(batch_id, status, queries, reports))
+        task.add_done_callback(lambda t: batch_judged(batch_id, t))
+        _BATCH_JUDGING[batch_id] = task
+    return {"batch_id": batch_id, "status": "judging"}
 
 
 @app.get("/health")
 async def health():
-    return {"status": "ok", "version": "1.0.0"}
+    # Probe concurrently so one dead agent costs one timeout, not four
+    probes = await asyncio.gather(*[
+        probe_agent(key, client) for key, client in app.state.clients.items()
+    ])
+    agents = dict(probes)
+    return {
+        "status": "ok" if all(v == "ok" for v in agents.values()) else "degraded",
+        "version": "1.0.0",
+        "agents": agents,
+    }
 
 
-@app.get("/demo-queries")
-async def demo_queries():
+@app.get("/cache-stats")
+async def cache_stats():
     return {
-        "queries": [
-            {
-                "name": "The N+1 Classic",
-                "dialect": "postgresql",
-                "sql": "SELECT *\nFROM orders o\nWHERE o.user_id IN (\n    SELECT id FROM users\n    WHERE created_at > '2024-01-01'\n    AND country = 'US'\n)\nORDER BY o.created_at DESC;"
-            },
-            {
-                "name": "The SELECT * Monster",
-                "dialect": "bigquery",
-                "sql": "SELECT *\nFROM events e\nJOIN users u ON e.user_id = u.id\nJOIN products p ON e.product_id = p.id\nJOIN sessions s ON e.session_id = s.id\nWHERE e.event_type = 'purchase'\nAND YEAR(e.created_at) = 2024\nORDER BY e.created_at DESC;"
-            },
-            {
-                "name": "The Missing Index Trap",
-                "dialect": "postgresql",
-                "sql": "SELECT customer_id, region, SUM(amount) AS total\nFROM transactions\nWHERE status = 'completed'\nAND created_at BETWEEN '2024-01-01' AND '2024-12-31'\nGROUP BY customer_id, region\nHAVING SUM(amount) > 1000\nORDER BY total DESC;"
-            },
-            {
-                "name": "The SQL Injection",
-                "dialect": "mysql",
-                "sql": "SELECT id, username, email, password_hash, ssn\nFROM users\nWHERE username = '$username'\nUNION SELECT * FROM admin_users WHERE '1'='1';"
-            },
-            {
-                "name": "The Cost Killer",
-                "dialect": "snowflake",
-                "sql": "SELECT DISTINCT u.*, o.*, p.*, r.*\nFROM users u, orders o, products p, reviews r\nWHERE u.id = o.user_id\nORDER BY u.created_at DESC;"
-            }
-        ]
+        "verdicts": _VERDICT_CACHE.stats(),
+        "agents": _AGENT_CACHE.stats(),
+        "judge": _JUDGE_CACHE.stats(),
+    }
+
+
+DEMO_QUERIES = [
+    {
+        "name": "The N+1 Classic",
+        "dialect": "postgresql",
+        "sql": "SELECT *\nFROM orders o\nWHERE o.user_id IN (\n    SELECT id FROM users\n    WHERE created_at > '2024-01-01'\n    AND country = 'US'\n)\nORDER BY o.created_at DESC;"
+    },
+    {
+        "name": "The SELECT * Monster",
+        "dialect": "bigquery",
+        "sql": "SELECT *\nFROM events e\nJOIN users u ON e.user_id = u.id\nJOIN products p ON e.product_id = p.id\nJOIN sessions s ON e.session_id = s.id\nWHERE e.event_type = 'purchase'\nAND YEAR(e.created_at) = 2024\nORDER BY e.created_at DESC;"
+    },
+    {
+        "name": "The Missing Index Trap",
+        "dialect": "postgresql",
+        "sql": "SELECT customer_id, region, SUM(amount) AS total\nFROM transactions\nWHERE status = 'completed'\nAND created_at BETWEEN '2024-01-01' AND '2024-12-31'\nGROUP BY customer_id, region\nHAVING SUM(amount) > 1000\nORDER BY total DESC;"
+    },
+    {
+        "name": "The SQL Injection",
+        "dialect": "mysql",
+        "sql": "SELECT id, username, email, password_hash, ssn\nFROM users\nWHERE username = '$username'\nUNION SELECT * FROM admin_users WHERE '1'='1';"
+    },
+    {
+        "name": "The Cost Killer",
+        "dialect": "snowflake",
+        "sql": "SELECT DISTINCT u.*, o.*, p.*, r.*\nFROM users u, orders o, products p, reviews r\nWHERE u.id = o.user_id\nORDER BY u.created_at DESC;"
     }
+]
+
+# Static content — serialized and fingerprinted once at import
+_DEMO_JSON = orjson.dumps({"queries": DEMO_QUERIES})
+_DEMO_ETAG = f'"{hashlib.md5(_DEMO_JSON).hexdigest()}"'
+_DEMO_HEADERS = {"ETag": _DEMO_ETAG, "Cache-Control": "public, max-age=86400, immutable"}
+
+
+@app.get("/demo-queries")
+async def demo_queries(request: Request):
+    if request.headers.get("if-none-match") == _DEMO_ETAG:
+        return Response(status_code=304, headers=_DEMO_HEADERS)
+    return Response(_DEMO_JSON, media_type="application/json", headers=_DEMO_HEADERS)
+
+
+# Content-hashed asset names (app.3f9a2c1d.js) never change content
+_FINGERPRINTED = re.compile(r"\.[0-9a-f]{8,}\.(?:js|css)$")
+_COMPRESSIBLE = {".html", ".js", ".css", ".svg", ".json"}
+
+
+class UIStaticFiles(StaticFiles):
+    """StaticFiles that serves text assets gzip-precompressed and marks
+    fingerprinted assets immutable; everything else revalidates via ETag.
+
+    Compressed copies are keyed on (realpath, mtime, size) — the same stat
+    the ETag comes from — so an edited file is recompressed on its next
+    request instead of serving stale bytes under the new validators.
+    """
+
+    def __init__(self, *, directory: str, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.gzipped: dict = {}
+        for path in pathlib.Path(directory).rglob("*"):
+            if path.suffix in _COMPRESSIBLE and path.is_file():
+                self.gzipped_body(str(path), path.stat())
+
+    def gzipped_body(self, path: str, stat: os.stat_result) -> Optional[bytes]:
+        """gzip copy of a compressible file as of `stat`, built on first use."""
+        if pathlib.Path(path).suffix not in _COMPRESSIBLE:
+            return None
+        realpath = os.path.realpath(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self.gzipped.get(realpath)
+        if cached is None or cached[0] != version:
+            cached = self.gzipped[realpath] = (
+                version, gzip.compress(pathlib.Path(path).read_bytes(), compresslevel=9)
+            )
+        return cached[1]
+
+    async def get_response(self, path: str, scope) -> Response:
+        response = await super().get_response(path, scope)
+        if not isinstance(response, FileResponse):
+            return response  # 404s, 304s and directory redirects pass through
+
+        cache_control = (
+            "public, max-age=31536000, immutable"
+            if _FINGERPRINTED.search(response.path) else "no-cache"
+        )
+        if "gzip" in Headers(scope=scope).get("accept-encoding", ""):
+            body = self.gzipped_body(response.path, response.stat_result)
+        else:
+            body = None
+        if body is None:
+            response.headers["Cache-Control"] = cache_control
+            return response
+
+        return Response(
+            body,
+            status_code=response.status_code,
+            media_type=response.media_type,
+            headers={
+                "Cache-Control": cache_control,
+                "Content-Encoding": "gzip",
+                "Vary": "Accept-Encoding",
+                "ETag": response.headers["etag"],
+                "Last-Modified": response.headers["last-modified"],
+            },
+        )
 
 
 # Serve the UI — absolute path so it works from any working directory
-import pathlib
 _THIS_DIR = pathlib.Path(__file__).parent
 _UI_DIR = _THIS_DIR.parent / "ui"
 if _UI_DIR.exists():
-    app.mount("/", StaticFiles(directory=str(_UI_DIR), html=True), name="ui")
+    app.mount("/", UIStaticFiles(directory=str(_UI_DIR), html=True), name="ui")
 else:
     import warnings
     warnings.warn(f"UI directory not found at {_UI_DIR}")
@@ -310,5 +1690,6 @@ else:
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("ORCHESTRATOR_PORT", "5000"))
-    logger.info(f"🎯 QuerySense Orchestrator starting on port {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
\ No newline at end of file
+    logger.info("🎯 QuerySense Orchestrator starting on port %s", port)
+    # uvloop + httptools ship with uvicorn[standard]; pin them rather than rely on "auto"
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="uvloop", http="httptools", log_level="info")
\ No newline at end of file
@@ -78,7 +78,7 @@ echo -e "${YELLOW}⏳ Waiting for agents to boot...${NC}"
 sleep 3
 
 echo -e "${GREEN}🎯 Starting Orchestrator (port 5000)...${NC}"
-cd orchestrator && PYTHONPATH=.. uvicorn main:app --host 0.0.0.0 --port 5000 --reload > ../logs/orchestrator.log 2>&1 &
+cd orchestrator && PYTHONPATH=.. uvicorn main:app --host 0.0.0.0 --port 5000 --loop uvloop --http httptools --reload > ../logs/orchestrator.log 2>&1 &
 ORCH_PID=$!
 cd ..
 